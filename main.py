@@ -1,7 +1,25 @@
 import os
 import logging
+import time
+import datetime
+import asyncio
+import functools
+import threading
+import hashlib
+import secrets
+import random
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+import uvloop
+# Install before any event loop is created by PTB or the server
+uvloop.install()
 import google.generativeai as genai
+from google.generativeai import caching
+import redis.asyncio as aioredis
+from cachetools import TTLCache
 from telegram import Update
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -9,43 +27,73 @@ from telegram.ext import (
     filters,
     CallbackContext
 )
-from flask import Flask, request, jsonify
-from google.cloud import secretmanager
-
-# Initialize Flask app
-app = Flask(__name__)
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
+from streaming import stream_reply, run_turn
+from triggers import normalize_message, match_trigger
+from google.cloud.logging.handlers import StructuredLogHandler
+from google.api_core.exceptions import GoogleAPIError, DeadlineExceeded, ServiceUnavailable
+from google.generativeai.types import BlockedPromptException, StopCandidateException
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
 # ======================
 # LOGGING CONFIGURATION
 # ======================
+# JSON lines on stdout are indexed by Cloud Logging without re-parsing
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=logging.INFO,
+    handlers=[StructuredLogHandler()]
 )
 logger = logging.getLogger('EnglishTeachingBot')
 
+# Fraction of per-message INFO records that are actually emitted
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.1'))
+
+def log_sampled(chat_id, msg, *args):
+    if logger.isEnabledFor(logging.INFO) and random.random() < LOG_SAMPLE_RATE:
+        logger.info(msg, *args, extra={"json_fields": {"chat_id": chat_id}})
+
 # ======================
 # SECRET MANAGEMENT
 # ======================
+_secret_client = None
+_secret_client_lock = threading.Lock()
+
+def get_secret_client():
+    # Imported on first use: deployments that mount secrets as env vars
+    # never pay for loading the Secret Manager client
+    global _secret_client
+    with _secret_client_lock:
+        if _secret_client is None:
+            from google.cloud import secretmanager
+            _secret_client = secretmanager.SecretManagerServiceClient()
+        return _secret_client
+
+@functools.lru_cache(maxsize=32)
 def access_secret(secret_name):
-    client = secretmanager.SecretManagerServiceClient()
+    # Secrets mounted as env vars (Cloud Run secret references) skip the RPC
+    if secret_name in os.environ:
+        return os.environ[secret_name]
     name = f"projects/{os.environ['GOOGLE_CLOUD_PROJECT']}/secrets/{secret_name}/versions/latest"
-    response = client.access_secret_version(name=name)
+    response = get_secret_client().access_secret_version(name=name)
     return response.payload.data.decode('UTF-8')
 
-TELEGRAM_TOKEN = access_secret('TELEGRAM_BOT_TOKEN')
-GEMINI_API_KEY = access_secret('GOOGLE_API_KEY')
+with ThreadPoolExecutor(max_workers=2) as executor:
+    TELEGRAM_TOKEN, GEMINI_API_KEY = executor.map(
+        access_secret, ['TELEGRAM_BOT_TOKEN', 'GOOGLE_API_KEY']
+    )
 
 # ======================
 # GEMINI AI SETUP
 # ======================
 genai.configure(api_key=GEMINI_API_KEY)
 
+# Greedy decoding (top_p/top_k are moot at temperature 0) keeps replies
+# deterministic, and 800 tokens comfortably fits a full teacher answer
 GENERATION_CONFIG = {
-    "temperature": 0.9,
-    "top_p": 1,
-    "top_k": 1,
-    "max_output_tokens": 2500,
+    "temperature": 0.0,
+    "max_output_tokens": 800,
 }
 
 SAFETY_SETTINGS = [
@@ -138,39 +186,298 @@ Namaste! Present perfect tense ke baare mein samjha deti hoon:
 
 Koi aur doubt hai?"""
 
-try:
-    model = genai.GenerativeModel(
-        model_name="gemini-1.5-flash-latest",
+# Explicit context caching needs a pinned model version, not a "-latest" alias
+CACHE_MODEL_NAME = "models/gemini-1.5-flash-001"
+FALLBACK_MODEL_NAME = "gemini-1.5-flash-latest"
+CACHE_TTL = datetime.timedelta(hours=1)
+CACHE_REFRESH_INTERVAL = 50 * 60  # seconds, comfortably inside CACHE_TTL
+# Gemini 1.5 Flash refuses to cache fewer tokens than this
+MIN_CACHE_TOKENS = 32_768
+# Off by default: the current instruction is far below MIN_CACHE_TOKENS,
+# so trying would only add a failing RPC to every cold start
+ENABLE_CONTEXT_CACHE = os.environ.get('ENABLE_CONTEXT_CACHE') == '1'
+
+def create_system_cache():
+    tokens = genai.GenerativeModel(CACHE_MODEL_NAME).count_tokens(SYSTEM_INSTRUCTION).total_tokens
+    if tokens < MIN_CACHE_TOKENS:
+        logger.info("System instruction has %s tokens, too few to cache", tokens)
+        return None
+    return caching.CachedContent.create(
+        model=CACHE_MODEL_NAME,
+        system_instruction=SYSTEM_INSTRUCTION,
+        ttl=CACHE_TTL
+    )
+
+def build_model(cache):
+    if cache is not None:
+        return genai.GenerativeModel.from_cached_content(
+            cached_content=cache,
+            generation_config=GENERATION_CONFIG,
+            safety_settings=SAFETY_SETTINGS
+        )
+    # Gemini rejects caches below its minimum token count; send the
+    # instruction as a plain system instruction instead of a history turn
+    return genai.GenerativeModel(
+        model_name=FALLBACK_MODEL_NAME,
         generation_config=GENERATION_CONFIG,
-        safety_settings=SAFETY_SETTINGS
+        safety_settings=SAFETY_SETTINGS,
+        system_instruction=SYSTEM_INSTRUCTION
     )
+
+system_cache = None
+if ENABLE_CONTEXT_CACHE:
+    try:
+        system_cache = create_system_cache()
+        if system_cache is not None:
+            logger.info("System instruction cached as %s", system_cache.name)
+    except Exception as e:
+        logger.warning("Context caching unavailable, using inline system instruction: %s", e)
+
+try:
+    model = build_model(system_cache)
     logger.info("Gemini model initialized successfully")
 except Exception as e:
-    logger.critical(f"Failed to initialize Gemini model: {e}")
+    logger.critical("Failed to initialize Gemini model: %s", e)
     raise
 
+async def refresh_system_cache():
+    """Keep the cached system instruction alive, recreating it if it expired."""
+    global system_cache, model
+    while True:
+        await asyncio.sleep(CACHE_REFRESH_INTERVAL)
+        try:
+            await asyncio.to_thread(system_cache.update, ttl=CACHE_TTL)
+            logger.info("Refreshed TTL for %s", system_cache.name)
+        except Exception as e:
+            logger.warning("Cache refresh failed, recreating: %s", e)
+            try:
+                system_cache = await asyncio.to_thread(create_system_cache)
+            except Exception as e:
+                logger.error("Failed to recreate system cache: %s", e)
+                system_cache = None
+            # Without a live cache, fall back to the inline instruction
+            # rather than keep a model bound to the expired one
+            model = build_model(system_cache)
+            # Open sessions still point at the old model; drop them so the
+            # next message starts over on the new one (history is
+            # rehydrated from Redis when it is configured)
+            conversation_manager.conversations.clear()
+            if system_cache is None:
+                logger.warning("Context cache disabled until restart")
+                return
+
 # ======================
 # CONVERSATION MANAGER
 # ======================
+# In-process LRU in front of Redis, so hot chats skip the roundtrip
+MAX_SESSIONS = 10_000
+SESSION_TTL = 3600  # seconds of inactivity before a local session is dropped
+REDIS_HISTORY_TTL = 86400  # seconds
+# Messages (user + model, so 10 turns) re-sent to Gemini with each request
+MAX_HISTORY_MESSAGES = 20
+
+REDIS_URL = os.environ.get('REDIS_URL')
+REDIS_TIMEOUT = 2.0  # seconds; a slow Redis must not stall the handlers
+redis_client = aioredis.from_url(
+    REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT
+) if REDIS_URL else None
+
+# chat:<id> holds the history and chat:<id>:version counts its saves. A
+# save only lands if nobody else saved since this copy was loaded, so a
+# replica with a stale session cannot overwrite turns taken elsewhere.
+SAVE_HISTORY_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return false
+end
+redis.call('SETEX', KEYS[1], ARGV[3], ARGV[2])
+local version = redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return version
+"""
+save_history_script = redis_client.register_script(SAVE_HISTORY_SCRIPT) if redis_client else None
+
+def history_keys(chat_id):
+    return f"chat:{chat_id}", f"chat:{chat_id}:version"
+
+def serialize_history(history):
+    return orjson.dumps([
+        {"role": content.role, "parts": [part.text for part in content.parts]}
+        for content in history
+    ])
+
+class Session:
+    def __init__(self, chat, version, persist=True):
+        self.chat = chat
+        # Redis version the history was loaded at or last saved as
+        self.version = version
+        # False when Redis could not be read: saving this empty history
+        # would wipe the stored one
+        self.persist = persist
+        # Just loaded from Redis, so the first turn can skip the version check
+        self.fresh = True
+        self.last_used = time.monotonic()
+        # Serialises turns of one chat: a ChatSession cannot take a second
+        # message while a streamed reply is still in flight
+        self.turn_lock = asyncio.Lock()
+
 class ConversationManager:
     def __init__(self):
-        self.conversations = {}
-        
+        # chat_id -> Session, least recently used first
+        self.conversations = OrderedDict()
+        # chat_id -> in-flight session creation, so concurrent first
+        # messages of one chat share a single Redis load while other chats
+        # are never blocked behind it
+        self._creating = {}
+
+    def _evict_stale(self, now):
+        while self.conversations:
+            session = next(iter(self.conversations.values()))
+            if now - session.last_used < SESSION_TTL:
+                break
+            self.conversations.popitem(last=False)
+
+    async def _load_history(self, chat_id):
+        """Return ``(history, version)``; raises when Redis cannot be read."""
+        if redis_client is None:
+            return [], "0"
+        history, version = await redis_client.mget(*history_keys(chat_id))
+        return orjson.loads(history or b"[]"), (version or b"0").decode()
+
+    def _touch(self, chat_id, now):
+        session = self.conversations.get(chat_id)
+        if session is not None:
+            session.last_used = now
+            self.conversations.move_to_end(chat_id)
+        return session
+
     async def get_chat(self, chat_id):
-        if chat_id not in self.conversations:
-            self.conversations[chat_id] = model.start_chat(
-                history=[{"role": "user", "parts": [SYSTEM_INSTRUCTION]}]
+        """Return the chat's Session; hold its turn_lock for the whole turn."""
+        now = time.monotonic()
+        self._evict_stale(now)
+
+        # Hot path: no awaits, so it cannot interleave with another handler
+        session = self._touch(chat_id, now)
+        if session is not None:
+            return session
+
+        creating = self._creating.get(chat_id)
+        if creating is None:
+            creating = asyncio.ensure_future(self._create_session(chat_id))
+            self._creating[chat_id] = creating
+            creating.add_done_callback(lambda _: self._creating.pop(chat_id, None))
+        # Shielded so one cancelled handler does not cancel the load for all
+        return await asyncio.shield(creating)
+
+    async def _create_session(self, chat_id):
+        try:
+            history, version = await self._load_history(chat_id)
+        except Exception as e:
+            logger.error("Failed to load history for %s: %s", chat_id, e)
+            # Neither cached nor saved, so the stored history survives
+            return Session(model.start_chat(history=[]), None, persist=False)
+        if len(self.conversations) >= MAX_SESSIONS:
+            self.conversations.popitem(last=False)
+        session = Session(model.start_chat(history=history), version)
+        self.conversations[chat_id] = session
+        log_sampled(chat_id, "Chat session for %s started with %s stored messages", chat_id, len(history))
+        return session
+
+    async def sync(self, chat_id, session):
+        """Reload ``session`` if another instance saved the chat since.
+
+        Call with ``session.turn_lock`` held.
+        """
+        if redis_client is None or not session.persist or session.fresh:
+            session.fresh = False
+            return
+        try:
+            version = (await redis_client.get(history_keys(chat_id)[1]) or b"0").decode()
+            if version == session.version:
+                return
+            history, version = await self._load_history(chat_id)
+        except Exception as e:
+            # Keep the local copy; a stale save is still refused by Redis
+            logger.error("Failed to check history version for %s: %s", chat_id, e)
+            return
+        session.chat = model.start_chat(history=history)
+        session.version = version
+        log_sampled(chat_id, "Reloaded history for %s at version %s", chat_id, version)
+
+    async def save_chat(self, chat_id, session):
+        chat = session.chat
+        # Keep only the latest turns so input tokens stay bounded; an even
+        # count keeps the history starting on a user turn
+        if len(chat.history) > MAX_HISTORY_MESSAGES:
+            chat.history = chat.history[-MAX_HISTORY_MESSAGES:]
+        if redis_client is None or not session.persist:
+            return
+        try:
+            version = await save_history_script(
+                keys=history_keys(chat_id),
+                args=[session.version, serialize_history(chat.history), REDIS_HISTORY_TTL]
             )
-            logger.info(f"New chat session started for {chat_id}")
-        return self.conversations[chat_id]
+        except Exception as e:
+            logger.error("Failed to save history for %s: %s", chat_id, e)
+            return
+        if version is None:
+            # Another instance saved first; drop this copy so the next
+            # message reloads instead of overwriting that turn
+            logger.warning("History for %s changed elsewhere; turn not saved", chat_id)
+            if self.conversations.get(chat_id) is session:
+                del self.conversations[chat_id]
+            return
+        session.version = str(version)
 
 conversation_manager = ConversationManager()
 
+# ======================
+# RESPONSE CACHE
+# ======================
+# Identical prompts in an identical conversation get the same greedy reply,
+# so they can skip Gemini entirely. The system instruction hash in the key
+# invalidates every entry when the prompt changes.
+SYSTEM_VERSION = hashlib.blake2b(SYSTEM_INSTRUCTION.encode(), digest_size=8).hexdigest()
+RESPONSE_CACHE_SIZE = 5000
+RESPONSE_CACHE_TTL = 86400  # seconds
+
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+def response_cache_key(chat, normalized_message):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(SYSTEM_VERSION.encode())
+    digest.update(serialize_history(chat.history))
+    digest.update(normalized_message.encode())
+    return digest.hexdigest()
+
+def record_turn(chat, user_message, reply):
+    """Append a cached exchange to the chat as if Gemini had produced it."""
+    chat.history = chat.history + [
+        {"role": "user", "parts": [user_message]},
+        {"role": "model", "parts": [reply]},
+    ]
+
 # ======================
 # TELEGRAM BOT SETUP
 # ======================
+TELEGRAM_POOL_SIZE = 256
+
 def setup_bot_application():
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # One keep-alive HTTP/2 pool shared by every outgoing Bot API call;
+    # getUpdates long-polls, so it gets its own small connection
+    request = HTTPXRequest(
+        connection_pool_size=TELEGRAM_POOL_SIZE,
+        http_version="2",
+        pool_timeout=5.0
+    )
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .request(request)
+        .get_updates_request(HTTPXRequest(http_version="2"))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler('start', start))
@@ -179,103 +486,296 @@ def setup_bot_application():
     
     return application
 
-bot_application = setup_bot_application()
-
 # ======================
 # TELEGRAM HANDLERS
 # ======================
+# Strong references keep fire-and-forget sends alive until they finish
+background_tasks = set()
+
+def _log_task_error(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background send failed: %s", task.exception())
+
+def send_in_background(coro):
+    """Run a Telegram send without holding up the handler."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_log_task_error)
+    return task
+
+# Cloud Functions (and Cloud Run with request-based CPU) throttle the
+# instance once the webhook response is sent, so replies scheduled after
+# it can stall or be lost. Only the always-on polling entry point
+# (polling.py) turns this on.
+BACKGROUND_SENDS = False
+
+async def deliver(coro):
+    """Send a final reply; in the background only when the process stays up."""
+    if BACKGROUND_SENDS:
+        send_in_background(coro)
+    else:
+        await coro
+
+WELCOME_TPL = (
+    "Namaste {name}!\n\n"
+    "Main Kritika hoon - aapki personal English teacher.\n\n"
+    "Mujhse aap poochh sakte hain:\n"
+    "• Grammar concepts\n• Sentence corrections\n• Translations\n"
+    "• Vocabulary doubts\n• Pronunciation help\n\n"
+    "Koi bhi English-related problem ho, bas message kijiye!\n\n"
+    "Chaliye shuru karte hain... Aaj aap kya seekhna chahenge?"
+)
+START_ERROR_MSG = "Kuch technical problem aa gayi hai. Kripya thodi der baad try karein."
+EMPTY_RESPONSE_MSG = (
+    "Maaf karna, main samjha nahi. Kya aap phir se try kar sakte hain?\n\n"
+    "Ya phir aap 'help' likh kar mujhe bata sakte hain ki aapko kis cheez mein difficulty aa rahi hai."
+)
+MESSAGE_ERROR_MSG = (
+    "Kuch technical problem aa raha hai. Hum team ko inform kar diya hai.\n\n"
+    "Kripya kuch samay baad phir try karein. Dhanyavaad!"
+)
+TELEGRAM_ERROR_MSG = (
+    "Kuch technical problem aa gayi hai. Hum ise fix kar rahe hain.\n\n"
+    "Kripya thodi der baad phir try karein. Dhanyavaad!"
+)
+
 async def start(update: Update, context: CallbackContext):
     try:
         chat_id = update.effective_chat.id
         user = update.effective_user
         await conversation_manager.get_chat(chat_id)
         
-        welcome_msg = (
-            f"Namaste {user.first_name}!\n\n"
-            "Main Kritika hoon - aapki personal English teacher.\n\n"
-            "Mujhse aap poochh sakte hain:\n"
-            "• Grammar concepts\n• Sentence corrections\n• Translations\n"
-            "• Vocabulary doubts\n• Pronunciation help\n\n"
-            "Koi bhi English-related problem ho, bas message kijiye!\n\n"
-            "Chaliye shuru karte hain... Aaj aap kya seekhna chahenge?"
-        )
-        await update.message.reply_text(welcome_msg)
-        logger.info(f"Sent welcome message to {chat_id}")
+        # Awaited so a failed send still reaches the START_ERROR_MSG path
+        await update.message.reply_text(WELCOME_TPL.format_map({"name": user.first_name}))
+        log_sampled(chat_id, "Sent welcome message to %s", chat_id)
     except Exception as e:
-        logger.error(f"Error in start handler: {e}", exc_info=True)
+        logger.error("Error in start handler: %s", e, exc_info=True)
         if update.effective_chat:
-            await update.effective_chat.send_message(
-                "Kuch technical problem aa gayi hai. Kripya thodi der baad try karein."
-            )
+            await update.effective_chat.send_message(START_ERROR_MSG)
+
+GEMINI_RPC_TIMEOUT = 15  # seconds, deadline passed down to the SDK call
+GEMINI_TIMEOUT = 20  # seconds, hard cap enforced on the event loop
+TRANSIENT_GEMINI_ERRORS = (asyncio.TimeoutError, DeadlineExceeded, ServiceUnavailable)
+# Quota, invalid-argument and blocked-prompt errors would fail the same way
+# without streaming, so they are never retried as a non-streamed request
+NO_FALLBACK_ERRORS = TRANSIENT_GEMINI_ERRORS + (
+    GoogleAPIError, BlockedPromptException, StopCandidateException
+)
+
+@retry(
+    retry=retry_if_exception_type(TRANSIENT_GEMINI_ERRORS),
+    stop=stop_after_attempt(2),
+    wait=wait_exponential_jitter(initial=0.5, max=4),
+    reraise=True
+)
+async def ask_gemini(chat, user_message, stream=False):
+    # A request that fails or times out never reaches chat.history, so
+    # retrying it on the same session is safe
+    return await asyncio.wait_for(
+        chat.send_message_async(
+            user_message,
+            stream=stream,
+            request_options={"timeout": GEMINI_RPC_TIMEOUT}
+        ),
+        timeout=GEMINI_TIMEOUT
+    )
+
+async def generate_reply(update: Update, chat, user_message):
+    try:
+        response = await ask_gemini(chat, user_message, stream=True)
+    except NO_FALLBACK_ERRORS:
+        raise
+    except Exception as e:
+        # Only a failure of the streaming call itself gets here; it never
+        # reached the chat history, so a plain retry without streaming is safe
+        logger.warning("Streaming failed, retrying without stream: %s", e)
+        response = await ask_gemini(chat, user_message)
+        if response.text:
+            await deliver(update.message.reply_text(response.text))
+        return response.text
+    return await stream_reply(update.message, response, deliver=deliver)
+
+async def send_reply(update: Update, chat, user_message):
+    # A stream that breaks off would otherwise leave the session unusable
+    return await run_turn(chat, lambda: generate_reply(update, chat, user_message))
 
 async def handle_message(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     user_message = update.message.text
     
     if not user_message:
-        logger.warning(f"Empty message from {chat_id}")
+        logger.warning("Empty message from %s", chat_id)
         return
 
     try:
-        logger.info(f"Processing message from {chat_id}: {user_message[:100]}...")
-        chat = await conversation_manager.get_chat(chat_id)
-        response = await chat.send_message(user_message)
+        log_sampled(chat_id, "Processing message from %s: %.100s", chat_id, user_message)
+        normalized = normalize_message(user_message)
+        canned = match_trigger(normalized)
+        if canned is not None:
+            await deliver(update.message.reply_text(canned))
+            log_sampled(chat_id, "Canned reply sent to %s", chat_id)
+            return
+
+        session = await conversation_manager.get_chat(chat_id)
+        # Messages from one chat take turns; other chats are unaffected
+        async with session.turn_lock:
+            await conversation_manager.sync(chat_id, session)
+            chat = session.chat
+            cache_key = response_cache_key(chat, normalized)
+            reply = response_cache.get(cache_key)
+            cache_hit = reply is not None
+            if cache_hit:
+                await deliver(update.message.reply_text(reply))
+                record_turn(chat, user_message, reply)
+                log_sampled(chat_id, "Cached reply used for %s", chat_id)
+            else:
+                # Raises unless the reply finished with STOP/MAX_TOKENS
+                reply = await send_reply(update, chat, user_message)
+            await conversation_manager.save_chat(chat_id, session)
+            # Only a turn that resolved cleanly (history readable and saved)
+            # may be replayed to other chats
+            if reply and not cache_hit:
+                response_cache[cache_key] = reply
         
-        if response.text:
-            await update.message.reply_text(response.text)
-            logger.info(f"Response sent to {chat_id}")
+        if reply:
+            log_sampled(chat_id, "Response sent to %s", chat_id)
         else:
-            logger.error(f"Empty response from Gemini for {chat_id}")
-            await update.message.reply_text(
-                "Maaf karna, main samjha nahi. Kya aap phir se try kar sakte hain?\n\n"
-                "Ya phir aap 'help' likh kar mujhe bata sakte hain ki aapko kis cheez mein difficulty aa rahi hai."
-            )
+            logger.error("Empty response from Gemini for %s", chat_id)
+            await update.message.reply_text(EMPTY_RESPONSE_MSG)
     except Exception as e:
-        logger.error(f"Error handling message for {chat_id}: {e}", exc_info=True)
+        # API errors (quota, deadlines) are frequent and self-explanatory;
+        # keep tracebacks for unexpected failures only
+        logger.error(
+            "Error handling message for %s: %s", chat_id, e,
+            exc_info=not isinstance(e, GoogleAPIError)
+        )
         if update.effective_chat:
-            await update.effective_chat.send_message(
-                "Kuch technical problem aa raha hai. Hum team ko inform kar diya hai.\n\n"
-                "Kripya kuch samay baad phir try karein. Dhanyavaad!"
-            )
+            await update.effective_chat.send_message(MESSAGE_ERROR_MSG)
 
 async def error_handler(update: Update, context: CallbackContext):
     error = context.error
-    logger.error(f"Telegram error: {error}", exc_info=True)
+    logger.error("Telegram error: %s", error, exc_info=True)
     
     if update and update.effective_chat:
         try:
-            await update.effective_chat.send_message(
-                "Kuch technical problem aa gayi hai. Hum ise fix kar rahe hain.\n\n"
-                "Kripya thodi der baad phir try karein. Dhanyavaad!"
-            )
+            await update.effective_chat.send_message(TELEGRAM_ERROR_MSG)
         except Exception as e:
-            logger.error(f"Failed to send error message: {e}")
+            logger.error("Failed to send error message: %s", e)
+
+# ======================
+# LIFECYCLE
+# ======================
+refresh_task = None
+
+async def warm_up():
+    """Open the Gemini (and Redis) connections before the first user does."""
+    # Application.initialize() already calls get_me, which warms Telegram
+    warmups = [model.count_tokens_async("warmup")]
+    if redis_client is not None:
+        warmups.append(redis_client.ping())
+    results = await asyncio.gather(*warmups, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("Connection warm-up failed: %s", result)
+
+async def on_startup(application: Application):
+    global refresh_task
+    await warm_up()
+    if system_cache is not None:
+        refresh_task = asyncio.create_task(refresh_system_cache())
+
+async def on_stop(application: Application):
+    if refresh_task is not None:
+        refresh_task.cancel()
+    # Let replies already scheduled reach Telegram before the pool closes
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+
+bot_application = setup_bot_application()
 
 # ======================
-# CLOUD FUNCTION ENDPOINTS
+# WEB ENDPOINTS
 # ======================
-@app.route('/webhook', methods=['POST'])
-async def webhook():
-    if request.method == "POST":
-        update = Update.de_json(request.get_json(force=True), bot_application.bot)
-        await bot_application.process_update(update)
-    return jsonify(success=True)
-
-@app.route('/set_webhook', methods=['GET'])
-async def set_webhook():
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # PTB must be initialized once so its HTTPX pool is shared by all updates.
+    # initialize() does not run post_init/post_stop; only run_polling does.
+    await bot_application.initialize()
+    await on_startup(bot_application)
+    yield
+    await on_stop(bot_application)
+    await bot_application.shutdown()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Updates of one webhook batch processed at the same time
+MAX_BATCH_CONCURRENCY = 32
+
+async def process_payload(payload, semaphore):
+    # Decoding happens here too, so one malformed element of a batch is
+    # logged and skipped instead of failing (and redelivering) the rest
+    async with semaphore:
+        try:
+            update = Update.de_json(payload, bot_application.bot)
+            await bot_application.process_update(update)
+            return True
+        except Exception as e:
+            logger.error("Failed to process update: %s", e)
+            return False
+
+@app.post('/webhook')
+async def webhook(request: Request):
+    # Accept a single update or a list of updates; a batch is dispatched
+    # concurrently so Gemini latency overlaps across users
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    payloads = data if isinstance(data, list) else [data]
+    semaphore = asyncio.Semaphore(MAX_BATCH_CONCURRENCY)
+    results = await asyncio.gather(
+        *(process_payload(payload, semaphore) for payload in payloads)
+    )
+    return {"success": True, "processed": sum(results), "failed": results.count(False)}
+
+# Only message updates have handlers; Telegram skips sending the rest
+ALLOWED_UPDATES = ["message"]
+WEBHOOK_MAX_CONNECTIONS = 100
+
+@app.get('/set_webhook')
+async def set_webhook(request: Request):
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    # Compare bytes: compare_digest rejects non-ASCII str, and Starlette
+    # decodes headers as latin-1
+    if not admin_token or not secrets.compare_digest(
+        request.headers.get('X-Admin-Token', '').encode(), admin_token.encode()
+    ):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
     url = f"https://{os.environ.get('GOOGLE_CLOUD_PROJECT')}.cloudfunctions.net/webhook"
-    await bot_application.bot.set_webhook(url)
-    return jsonify(success=True, url=url)
-
-@app.route('/')
-def health_check():
-    return jsonify(
-        status="healthy",
-        service="english-teaching-bot",
-        telegram_ready=bot_application is not None,
-        gemini_ready=model is not None
+    info = await bot_application.bot.get_webhook_info()
+    if info.url == url and list(info.allowed_updates or []) == ALLOWED_UPDATES:
+        return {"success": True, "url": url, "changed": False}
+
+    await bot_application.bot.set_webhook(
+        url,
+        allowed_updates=ALLOWED_UPDATES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS
     )
+    logger.info("Webhook set to %s", url)
+    return {"success": True, "url": url, "changed": True}
+
+@app.get('/')
+async def health_check():
+    return {
+        "status": "healthy",
+        "service": "english-teaching-bot",
+        "telegram_ready": bot_application is not None,
+        "gemini_ready": model is not None
+    }
 
 # For local testing
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)), loop='uvloop')
@@ -0,0 +1,18 @@
+"""Long-polling entry point for single-instance deployments.
+
+Run this on one always-on instance to avoid per-request cold starts;
+keep the webhook (main:app) for multi-instance scale-out. Telegram
+refuses getUpdates while a webhook is set, so run_polling removes it.
+"""
+import main
+
+if __name__ == '__main__':
+    # The process outlives each update here, so replies can be sent
+    # without holding up the next one
+    main.BACKGROUND_SENDS = True
+    main.bot_application.run_polling(
+        allowed_updates=main.ALLOWED_UPDATES,
+        drop_pending_updates=True,
+        poll_interval=0,
+        timeout=30
+    )
@@ -0,0 +1,102 @@
+import logging
+import time
+
+STREAM_FIRST_CHUNK_CHARS = 200
+STREAM_EDIT_INTERVAL = 1.0  # seconds; Telegram rate-limits message edits
+# Any other finish (SAFETY, RECITATION, ...) leaves a truncated reply
+CLEAN_FINISH_REASONS = ("STOP", "MAX_TOKENS")
+
+logger = logging.getLogger('EnglishTeachingBot')
+
+
+class IncompleteReplyError(Exception):
+    """Gemini stopped streaming before finishing its answer."""
+
+
+def chunk_text(chunk):
+    try:
+        return chunk.text
+    except ValueError:
+        # Chunks without text parts (e.g. a final finish_reason chunk)
+        return ""
+
+
+def chunk_finish_reason(chunk):
+    for candidate in chunk.candidates:
+        # FINISH_REASON_UNSPECIFIED (0) marks chunks mid-stream
+        if candidate.finish_reason:
+            return candidate.finish_reason.name
+    return None
+
+
+async def _send_now(coro):
+    return await coro
+
+
+async def _preview(coro):
+    # Intermediate sends are cosmetic (RetryAfter, "message is not
+    # modified", ...); only the final delivery decides the turn
+    try:
+        return await coro
+    except Exception as e:
+        logger.warning("Streaming preview update failed: %s", e)
+        return None
+
+
+async def stream_reply(incoming, response, deliver=_send_now):
+    """Show Gemini's reply while it is generated by editing one message.
+
+    ``deliver`` sends the final message or edit, and its failure fails the
+    turn. Intermediate previews are awaited so they stay in order, but a
+    failed preview is only logged.
+    """
+    text = ""
+    sent_text = ""
+    message = None
+    last_edit = 0.0
+    finish_reason = None
+    async for chunk in response:
+        text += chunk_text(chunk)
+        finish_reason = chunk_finish_reason(chunk) or finish_reason
+        now = time.monotonic()
+        # Telegram trims messages, so whitespace-only growth is no change
+        if now - last_edit < STREAM_EDIT_INTERVAL or text.strip() == sent_text.strip():
+            continue
+        if message is None:
+            if len(text) >= STREAM_FIRST_CHUNK_CHARS:
+                message = await _preview(incoming.reply_text(text))
+                if message is not None:
+                    sent_text = text
+                last_edit = now
+        else:
+            if await _preview(message.edit_text(text)) is not None:
+                sent_text = text
+            last_edit = now
+
+    if finish_reason not in CLEAN_FINISH_REASONS:
+        raise IncompleteReplyError(f"Stream finished with {finish_reason}")
+
+    if message is None:
+        if text:
+            await deliver(incoming.reply_text(text))
+    elif text.strip() != sent_text.strip():
+        await deliver(message.edit_text(text))
+    return text
+
+
+async def run_turn(chat, turn):
+    """Run ``turn()`` against ``chat``, rolling its history back on failure.
+
+    A ChatSession whose streamed response did not finish cleanly raises on
+    every later ``history`` read; restoring the snapshot through the setter
+    clears that state so the session keeps working.
+    """
+    snapshot = list(chat.history)
+    try:
+        reply = await turn()
+        # Raises here, inside the rollback, if the response never resolved
+        list(chat.history)
+        return reply
+    except BaseException:
+        chat.history = snapshot
+        raise
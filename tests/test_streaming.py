@@ -0,0 +1,148 @@
+import asyncio
+import enum
+from types import SimpleNamespace
+
+import pytest
+
+from streaming import IncompleteReplyError, run_turn, stream_reply
+
+
+class FinishReason(enum.IntEnum):
+    FINISH_REASON_UNSPECIFIED = 0
+    STOP = 1
+    MAX_TOKENS = 2
+    SAFETY = 3
+
+
+def chunk(text, finish_reason=FinishReason.FINISH_REASON_UNSPECIFIED):
+    return SimpleNamespace(
+        text=text, candidates=[SimpleNamespace(finish_reason=finish_reason)]
+    )
+
+
+class FakeStream:
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+
+    async def __aiter__(self):
+        for item in self.chunks:
+            yield item
+        if self.error is not None:
+            raise self.error
+
+
+class FakeChat:
+    """Mimics ChatSession: history is unreadable while a response is pending."""
+
+    def __init__(self, history):
+        self._history = list(history)
+        self._last_received = None
+
+    @property
+    def history(self):
+        if self._last_received is not None:
+            raise RuntimeError("IncompleteIterationError")
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        self._history = list(history)
+        self._last_received = None
+
+    async def send(self, incoming, stream):
+        self._last_received = stream
+        text = await stream_reply(incoming, stream)
+        self._history += ["user", text]
+        self._last_received = None
+        return text
+
+
+class FakeMessage:
+    def __init__(self):
+        self.sent = []
+
+    async def reply_text(self, text):
+        self.sent.append(text)
+        return self
+
+    async def edit_text(self, text):
+        self.sent.append(text)
+
+
+def test_stream_sends_full_reply():
+    chat = FakeChat(["u1", "m1"])
+    incoming = FakeMessage()
+    stream = FakeStream([chunk("a" * 250), chunk("b", FinishReason.STOP)])
+
+    reply = asyncio.run(run_turn(chat, lambda: chat.send(incoming, stream)))
+
+    assert reply == "a" * 250 + "b"
+    assert incoming.sent[-1] == reply
+    assert chat.history == ["u1", "m1", "user", reply]
+
+
+def test_stream_error_mid_iteration_restores_history():
+    chat = FakeChat(["u1", "m1"])
+    stream = FakeStream([chunk("a" * 250)], error=ConnectionError("reset"))
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(run_turn(chat, lambda: chat.send(FakeMessage(), stream)))
+
+    assert chat.history == ["u1", "m1"]
+
+
+def test_failed_preview_does_not_abort_the_turn():
+    class FlakyMessage(FakeMessage):
+        calls = 0
+
+        async def reply_text(self, text):
+            self.calls += 1
+            if self.calls == 1:
+                raise RuntimeError("RetryAfter")
+            return await super().reply_text(text)
+
+    chat = FakeChat(["u1", "m1"])
+    incoming = FlakyMessage()
+    stream = FakeStream([chunk("a" * 250), chunk("b", FinishReason.STOP)])
+
+    reply = asyncio.run(run_turn(chat, lambda: chat.send(incoming, stream)))
+
+    assert incoming.sent == [reply]
+    assert chat.history == ["u1", "m1", "user", reply]
+
+
+def test_failed_final_delivery_restores_history():
+    class FailingMessage(FakeMessage):
+        async def reply_text(self, text):
+            raise RuntimeError("RetryAfter")
+
+    chat = FakeChat(["u1", "m1"])
+    stream = FakeStream([chunk("a" * 250), chunk("b", FinishReason.STOP)])
+
+    with pytest.raises(RuntimeError, match="RetryAfter"):
+        asyncio.run(run_turn(chat, lambda: chat.send(FailingMessage(), stream)))
+
+    assert chat.history == ["u1", "m1"]
+
+
+def test_whitespace_only_growth_is_not_edited():
+    chat = FakeChat([])
+    incoming = FakeMessage()
+    stream = FakeStream([chunk("a" * 250), chunk(" \n", FinishReason.STOP)])
+
+    asyncio.run(run_turn(chat, lambda: chat.send(incoming, stream)))
+
+    assert incoming.sent == ["a" * 250]
+
+
+def test_unclean_finish_raises_and_restores_history():
+    chat = FakeChat(["u1", "m1"])
+    incoming = FakeMessage()
+    stream = FakeStream([chunk("partial", FinishReason.SAFETY)])
+
+    with pytest.raises(IncompleteReplyError):
+        asyncio.run(run_turn(chat, lambda: chat.send(incoming, stream)))
+
+    assert incoming.sent == []
+    assert chat.history == ["u1", "m1"]
@@ -0,0 +1,18 @@
+import pytest
+
+from triggers import HELP_REPLY, match_trigger, normalize_message
+
+
+@pytest.mark.parametrize("message", ["help", "Help!", "  HELP?  ", "madad", "Kya kar sakti ho?"])
+def test_whole_message_trigger_gets_canned_reply(message):
+    assert match_trigger(normalize_message(message)) == HELP_REPLY
+
+
+@pytest.mark.parametrize("message", [
+    "help with present perfect",
+    "tenses mein madad chahiye",
+    "helpful",
+    "present perfect tense samjhao",
+])
+def test_questions_mentioning_a_trigger_go_to_gemini(message):
+    assert match_trigger(normalize_message(message)) is None
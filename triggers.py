@@ -0,0 +1,27 @@
+HELP_REPLY = (
+    "Main aapki English mein madad kar sakti hoon!\n\n"
+    "Aap mujhse ye sab pooch sakte hain:\n"
+    "• Kisi grammar topic ko samjhana - jaise \"Present perfect tense samjhao\"\n"
+    "• Sentence correction - apna sentence bhejiye, main sahi karke bataungi\n"
+    "• Translation - \"Isko English mein kaise bolenge?\"\n"
+    "• Vocabulary aur pronunciation doubts\n\n"
+    "Bas apna sawal likhiye. Aaj kya seekhna chahenge?"
+)
+
+# Keyword -> canned reply. "samjhao" is deliberately absent: it comes with
+# a topic to explain, which needs Gemini.
+TRIGGERS = {
+    "help": HELP_REPLY,
+    "madad": HELP_REPLY,
+    "what can you do": HELP_REPLY,
+    "kya kar sakti ho": HELP_REPLY,
+}
+
+def normalize_message(text):
+    return " ".join(text.lower().split())
+
+def match_trigger(normalized):
+    """Return a canned reply when the whole message is a trigger phrase."""
+    # Messages that only mention a trigger ("tenses mein madad chahiye")
+    # are real questions and go to Gemini
+    return TRIGGERS.get(normalized.rstrip("!?. "))